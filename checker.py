@@ -1,15 +1,19 @@
 
 import os
 import asyncio
-from datetime import datetime, timedelta
-from playwright.async_api import async_playwright
+import time
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from playwright.async_api import async_playwright, Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
 import re
 import json
-import urllib.request
+import hashlib
+import logging
+import http.client
 import urllib.parse
 import base64
-import psycopg2
-from psycopg2.extras import execute_values
+
+log = logging.getLogger("checker")
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 
@@ -18,15 +22,40 @@ MAILGUN_DOMAIN = os.getenv("MAILGUN_DOMAIN", "my-pau.com")
 MAILGUN_SENDER_EMAIL = os.getenv("MAILGUN_SENDER_EMAIL", f"eurostar@{MAILGUN_DOMAIN}")
 EMAIL_RECIPIENT = os.getenv("EMAIL_RECIPIENT")
 
+MAILGUN_CONNECT_TIMEOUT = 10
+MAILGUN_READ_TIMEOUT = 20
+MAILGUN_MAX_ATTEMPTS = 3
+# When set, skip the email if the results match the digest stored here by the last send.
+EMAIL_DIGEST_PATH = os.getenv("EMAIL_DIGEST_PATH")
+
 if not EMAIL_RECIPIENT:
     raise RuntimeError("Missing env var: set EMAIL_RECIPIENT")
 if not MAILGUN_API_KEY:
     raise RuntimeError("Missing env var MAILGUN_API_KEY")
 
+def _looks_like_email(address: str) -> bool:
+    return "@" in address and "." in address.split("@", 1)[1]
+
+RECIPIENTS = [r.strip() for r in EMAIL_RECIPIENT.split(",") if r.strip()]
+_BAD_RECIPIENTS = [r for r in RECIPIENTS if not _looks_like_email(r)]
+if _BAD_RECIPIENTS:
+    raise RuntimeError(f"Invalid address(es) in env var EMAIL_RECIPIENT: {_BAD_RECIPIENTS}")
+if not RECIPIENTS:
+    raise RuntimeError("No valid address in env var EMAIL_RECIPIENT")
+if not _looks_like_email(MAILGUN_SENDER_EMAIL):
+    raise RuntimeError("Invalid address in env var MAILGUN_SENDER_EMAIL")
+
+_DB_CONN = None
+
 def get_db_conn():
+    global _DB_CONN
     if not DATABASE_URL:
         raise RuntimeError("Missing env var: DATABASE_URL")
-    return psycopg2.connect(DATABASE_URL)
+    if _DB_CONN is None or _DB_CONN.closed:
+        # Imported here so runs without a database never load libpq.
+        import psycopg2
+        _DB_CONN = psycopg2.connect(DATABASE_URL)
+    return _DB_CONN
 
 def init_db():
     with get_db_conn() as conn:
@@ -53,9 +82,14 @@ def init_db():
                     created_at TIMESTAMP NOT NULL DEFAULT NOW()
                 )
             """)
+            cur.execute("""
+                CREATE INDEX IF NOT EXISTS idx_search_results_run_date
+                    ON search_results (run_id, travel_date)
+            """)
         conn.commit()
 
 def save_run_to_db(all_results, error_message=None):
+    from psycopg2.extras import execute_values
     status = "error" if error_message else "success"
     with get_db_conn() as conn:
         with conn.cursor() as cur:
@@ -102,72 +136,133 @@ def save_run_to_db(all_results, error_message=None):
                 """, rows)
 
         conn.commit()
-    print(f"[DB] Run #{run_id} enregistré ({len(rows)} résultats).")
+    log.info("[DB] Run #%s enregistré (%d résultats).", run_id, len(rows))
     return run_id
 
-SNAP_PARIS_TO_AMS = "https://snap.eurostar.com/fr-fr/search?adult=1&origin=8727100&destination=8400058&outbound={date}"
-SNAP_AMS_TO_PARIS = "https://snap.eurostar.com/fr-fr/search?adult=1&origin=8400058&destination=8727100&outbound={date}"
+SNAP_SEARCH_URL = "https://snap.eurostar.com/fr-fr/search"
+SNAP_PARIS_TO_AMS = (SNAP_SEARCH_URL, {"adult": "1", "origin": "8727100", "destination": "8400058"})
+SNAP_AMS_TO_PARIS = (SNAP_SEARCH_URL, {"adult": "1", "origin": "8400058", "destination": "8727100"})
+SNAP_MAX_PARALLEL_PAGES = 8
+SNAP_MAX_ATTEMPTS = 3
+# Stop a route after this many consecutive dates with nothing available (0 = check every date).
+# When set, dates are fetched in ordered batches of this size instead of all at once.
+EARLY_STOP_STREAK = int(os.getenv("EARLY_STOP_STREAK", "0"))
+
+_CHROMIUM_ARGS = (
+    "--disable-gpu", "--disable-extensions", "--disable-background-networking",
+    "--disable-features=TranslateUI,BackForwardCache", "--disable-dev-shm-usage",
+    "--hide-scrollbars", "--mute-audio",
+)
+_SNAP_VIEWPORT = {"width": 1024, "height": 768}
+
+_SNAP_BLOCKED_RESOURCE_TYPES = frozenset(("image", "font", "media", "manifest", "texttrack"))
+_SNAP_BLOCKED_DOMAINS = (
+    "google-analytics.com", "googletagmanager.com", "doubleclick.net",
+    "hotjar.com", "segment.com", "segment.io",
+)
+
+_RE_HM = re.compile(r"(\d{1,2})[h:](\d{2})")
+_RANGE_SEPARATORS = frozenset(("et", "and", "-", "–", "—", "to", "à"))
+_RE_LOOSE = re.compile(r"(\d{1,2})(?::?(\d{2}))?\s*(?:-|–|—|to|à)\s*(\d{1,2})(?::?(\d{2}))?")
+_RE_PRICE = re.compile(r"(\d+(?:\.\d+)?)")
+_PRICE_TRANS = str.maketrans({"\u202f": None, ",": "."})
+
+# Tried narrowest first; the broad class-substring scan only runs when nothing more specific matches.
+_SNAP_PRICE_SELECTORS = ("[data-testid$='-price']", "[data-testid*='price']", "[class*='price']")
+
+_SNAP_EXTRACT_JS = """
+window.__snapExtractOffers = (selectors) => {
+    const TIME_SELECTOR = "[data-testid*='time'], time, [class*='time'], [class*='hour'], [class*='departure'], [class*='schedule']";
+    function findContainer(node){
+        let cur = node;
+        for (let i=0;i<8 && cur;i++){
+            const hasPrice = cur.querySelector(selector);
+            const hasTime  = cur.querySelector(TIME_SELECTOR);
+            if (hasPrice && (hasTime || i>0)) return cur;
+            cur = cur.parentElement;
+        }
+        return node;
+    }
+    function findTimeElements(container){
+        let timeElements = [];
+        container.querySelectorAll(TIME_SELECTOR).forEach(el=>{
+            if (el.innerText && el.innerText.trim()) timeElements.push(el.innerText.trim());
+        });
+        const containerText = container.innerText || "";
+        const m = containerText.match(/(\\d{1,2}:\\d{2})\\s*(?:-|–|—|to|à)\\s*(\\d{1,2}:\\d{2})/gi);
+        if (m) timeElements.push(...m);
+        return timeElements;
+    }
+    let selector = selectors[0], nodes = [];
+    for (const sel of selectors){
+        nodes = document.querySelectorAll(sel);
+        if (nodes.length){ selector = sel; break; }
+    }
+    const seen = new Map();
+    const offers = [];
+    nodes.forEach(el => {
+        const container = findContainer(el);
+        const priceText = el.innerText ? el.innerText.trim() : '';
+        let prices = seen.get(container);
+        if (!prices){ prices = new Set(); seen.set(container, prices); }
+        if (prices.has(priceText)) return;
+        prices.add(priceText);
+        const timeElements = findTimeElements(container);
+        const labelEl = container.querySelector("[data-testid*='band'], [data-testid*='period'], [class*='morning'], [class*='afternoon'], [class*='matin'], [class*='apres']");
+        offers.push({
+            priceText: priceText,
+            containerText: container && container.innerText ? container.innerText : '',
+            timeElements: timeElements,
+            labelText: labelEl && labelEl.innerText ? labelEl.innerText : ''
+        });
+    });
+    return offers;
+};
+"""
+
+_SNAP_EXTRACT_CALL = "(selectors) => window.__snapExtractOffers(selectors)"
 
 def _normalize_time_component(value: int) -> str:
     return f"{value:02d}"
 
-def _normalize_time_string(time_str: str) -> str:
-    if not time_str:
-        return ""
-    cleaned = time_str.strip().lower().replace("h", ":")
-    m = re.search(r"(\d{1,2}):(\d{2})", cleaned)
-    if not m:
-        return ""
-    hour = int(m.group(1))
-    minute = int(m.group(2))
-    return f"{_normalize_time_component(hour)}:{_normalize_time_component(minute)}"
-
+@lru_cache(maxsize=512)
 def _parse_time_range_from_text(text: str):
     if not text:
         return None
     lowered = text.strip().lower()
-    m = re.search(r'départ\s+entre\s+(\d{1,2}):(\d{2})\s+et\s+(\d{1,2}):(\d{2})', lowered)
-    if m:
-        sh, sm, eh, em = map(int, m.groups())
-        return f"{_normalize_time_component(sh)}:{_normalize_time_component(sm)}", f"{_normalize_time_component(eh)}:{_normalize_time_component(em)}"
-    m = re.search(r'départ\s+entre\s+(\d{1,2})h(\d{2})\s+et\s+(\d{1,2})h(\d{2})', lowered)
-    if m:
-        sh, sm, eh, em = map(int, m.groups())
-        return f"{_normalize_time_component(sh)}:{_normalize_time_component(sm)}", f"{_normalize_time_component(eh)}:{_normalize_time_component(em)}"
-    m = re.search(r'departure\s+between\s+(\d{1,2}):(\d{2})\s+and\s+(\d{1,2}):(\d{2})', lowered)
-    if m:
-        sh, sm, eh, em = map(int, m.groups())
-        return f"{_normalize_time_component(sh)}:{_normalize_time_component(sm)}", f"{_normalize_time_component(eh)}:{_normalize_time_component(em)}"
-    m = re.search(r"(\d{1,2}:\d{2})\s*(?:-|–|—|to|à)\s*(\d{1,2}:\d{2})", lowered)
-    if m:
-        start = _normalize_time_string(m.group(1)); end = _normalize_time_string(m.group(2))
-        if start and end:
-            return start, end
-    m2 = re.search(r"(\d{1,2})(?::?(\d{2}))?\s*(?:-|–|—|to|à)\s*(\d{1,2})(?::?(\d{2}))?", lowered)
+    tokens = list(_RE_HM.finditer(lowered))
+    for first, second in zip(tokens, tokens[1:]):
+        if lowered[first.end():second.start()].strip() in _RANGE_SEPARATORS:
+            sh, sm = map(int, first.groups())
+            eh, em = map(int, second.groups())
+            return f"{_normalize_time_component(sh)}:{_normalize_time_component(sm)}", f"{_normalize_time_component(eh)}:{_normalize_time_component(em)}"
+    m2 = _RE_LOOSE.search(lowered)
     if m2:
         sh = int(m2.group(1)); sm = int(m2.group(2) or 0); eh = int(m2.group(3)); em = int(m2.group(4) or 0)
         return f"{_normalize_time_component(sh)}:{_normalize_time_component(sm)}", f"{_normalize_time_component(eh)}:{_normalize_time_component(em)}"
     return None
 
+@lru_cache(maxsize=256)
 def _infer_band(label_text: str, time_range):
     text = (label_text or "").lower()
-    if any(k in text for k in ["morning", "matin"]):
+    if "morning" in text or "matin" in text:
         return "morning"
-    if any(k in text for k in ["afternoon", "apres", "après"]):
+    if "afternoon" in text or "apres" in text or "après" in text:
         return "afternoon"
     if time_range:
         try:
-            start_hour = int(time_range[0].split(":")[0])
+            start_hour = int(time_range[0][:2])
             return "morning" if start_hour < 14 else "afternoon"
         except Exception:
             return None
     return None
 
+@lru_cache(maxsize=512)
 def _price_to_float(price_text: str) -> float:
     if not price_text:
         return float("inf")
-    normalized = price_text.replace("\u202f", "").replace(",", ".")
-    m = re.search(r"(\d+(?:\.\d+)?)", normalized)
+    normalized = price_text.translate(_PRICE_TRANS)
+    m = _RE_PRICE.search(normalized)
     if not m:
         return float("inf")
     try:
@@ -175,203 +270,302 @@ def _price_to_float(price_text: str) -> float:
     except Exception:
         return float("inf")
 
-def _merge_time_ranges(time_ranges):
-    if not time_ranges:
-        return None
-    def to_minutes(t):
-        h, m = t.split(":")
-        return int(h) * 60 + int(m)
-    starts = sorted(time_ranges, key=lambda r: to_minutes(r[0]))
-    ends = sorted(time_ranges, key=lambda r: to_minutes(r[1]), reverse=True)
-    return starts[0][0], ends[0][1]
+def _to_minutes(t: str) -> int:
+    h, m = t.split(":")
+    return int(h) * 60 + int(m)
+
+_DAY_NAMES = ("Monday","Tuesday","Wednesday","Thursday","Friday","Saturday","Sunday")
+_MONTH_NAMES = ("January","February","March","April","May","June","July","August","September","October","November","December")
+_ORD_SUFFIX = tuple(
+    "st" if d in (1, 21, 31) else "nd" if d in (2, 22) else "rd" if d in (3, 23) else "th"
+    for d in range(32)
+)
 
+@lru_cache(maxsize=64)
 def _format_date_for_display(date_str: str) -> str:
     try:
         date_obj = datetime.strptime(date_str, "%Y-%m-%d")
-        day_names = ["Monday","Tuesday","Wednesday","Thursday","Friday","Saturday","Sunday"]
-        day_name = day_names[date_obj.weekday()]
         day = date_obj.day
-        suffix = "th" if 4 <= day <= 20 or 24 <= day <= 30 else ["st","nd","rd"][day % 10 - 1]
-        month_names = ["January","February","March","April","May","June","July","August","September","October","November","December"]
-        month_name = month_names[date_obj.month-1]
-        return f"{day_name} {day}{suffix} {month_name} {date_obj.year}"
+        return f"{_DAY_NAMES[date_obj.weekday()]} {day}{_ORD_SUFFIX[day]} {_MONTH_NAMES[date_obj.month-1]} {date_obj.year}"
     except Exception:
         return date_str
 
-async def check_snap(playwright, route_name, base_url):
-    browser = await playwright.chromium.launch()
-    page = await browser.new_page()
-    results = []
+async def _block_unneeded_requests(route):
+    request = route.request
+    host = urllib.parse.urlsplit(request.url).hostname or ""
+    if request.resource_type in _SNAP_BLOCKED_RESOURCE_TYPES or any(host == d or host.endswith("." + d) for d in _SNAP_BLOCKED_DOMAINS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def _new_snap_context(browser):
+    ctx = await browser.new_context(viewport=_SNAP_VIEWPORT)
+    await ctx.add_init_script(_SNAP_EXTRACT_JS)
+    await ctx.route("**/*", _block_unneeded_requests)
+    return ctx
+
+async def _scrape_snap_page(page, route_name, travel_date, url):
+    await page.goto(url, timeout=30000, wait_until="domcontentloaded")
+    try:
+        # Only a rendered Snap fare price means results are in; the broad fallbacks also hit skeletons and filters.
+        await page.wait_for_selector(_SNAP_PRICE_SELECTORS[0], state="visible", timeout=10000)
+    except PlaywrightTimeoutError:
+        pass
+
+    blocks = await page.evaluate(_SNAP_EXTRACT_CALL, list(_SNAP_PRICE_SELECTORS))
+    log.debug("Found %d price blocks for %s", len(blocks), travel_date)
+
+    offers = []
+    for block in blocks:
+        price_text = block.get("priceText", "")
+        container_text = block.get("containerText", "")
+        time_elements = block.get("timeElements", [])
+        label_text = block.get("labelText", "")
+
+        time_range = None
+        for time_text in time_elements:
+            time_range = _parse_time_range_from_text(time_text)
+            if time_range: break
+        if not time_range:
+            time_range = _parse_time_range_from_text(container_text)
+
+        band = _infer_band(label_text, time_range) or ("morning" if (time_range and int(time_range[0][:2]) < 14) else "afternoon")
+
+        if time_range:
+            offers.append({
+                "band": band,
+                "price_text": price_text,
+                "time_range": time_range,
+                "price_num": _price_to_float(price_text),
+                "start_min": _to_minutes(time_range[0]),
+                "end_min": _to_minutes(time_range[1]),
+            })
+
+    if offers:
+        acc = {}
+        for o in offers:
+            slot = acc.get(o["band"])
+            if slot is None:
+                acc[o["band"]] = {"best": o, "earliest": o, "latest": o}
+                continue
+            if o["price_num"] < slot["best"]["price_num"]:
+                slot["best"] = o
+            if o["start_min"] < slot["earliest"]["start_min"]:
+                slot["earliest"] = o
+            if o["end_min"] > slot["latest"]["end_min"]:
+                slot["latest"] = o
+        entry = {"route": route_name, "date": travel_date, "url": url, "morning": None, "afternoon": None}
+        for band, slot in acc.items():
+            merged = (slot["earliest"]["time_range"][0], slot["latest"]["time_range"][1])
+            entry[band] = {"price_text": slot["best"]["price_text"], "time_range": merged, "url": url}
+        if entry["morning"] or entry["afternoon"]:
+            return entry
+        return None
+    return {"route": route_name, "date": travel_date, "url": url, "morning": None, "afternoon": None}
 
-    for i in range(1, 9):
-        date = (datetime.now() + timedelta(days=i)).strftime("%Y-%m-%d")
-        url = base_url.format(date=date)
-        print(f"[Snap] Checking {route_name}: {url}")
+async def _fetch_snap_date(browser, sem, route_name, travel_date, url):
+    async with sem:
+        log.info("[Snap] Checking %s: %s", route_name, url)
+        ctx = None
         try:
-            await page.goto(url, timeout=60000)
-            await page.wait_for_timeout(5000)
-
-            price_blocks = await page.query_selector_all("div[data-testid$='-price'], [data-testid*='price'], .price, [class*='price']")
-            print(f"[DEBUG] Found {len(price_blocks)} price blocks for {date}")
-            if not price_blocks:
-                all_text = await page.inner_text("body")
-                price_pattern = re.findall(r'€\s*\d+[\.,]?\d*|\d+[\.,]?\d*\s*€', all_text)
-                if price_pattern:
-                    print(f"[DEBUG] Found prices in text: {price_pattern[:3]}...")
-                    price_blocks = [None] * len(price_pattern)
-
-            offers = []
-            for block in price_blocks:
+            ctx = await _new_snap_context(browser)
+            page = await ctx.new_page()
+            for attempt in range(SNAP_MAX_ATTEMPTS):
                 try:
-                    price_text = (await block.inner_text()).strip() if block else "€XX (debug)"
-                except Exception:
-                    continue
-
-                if block:
-                    try:
-                        info = await block.evaluate("""
-                            (el) => {
-                                function findContainer(node){
-                                    let cur = node;
-                                    for (let i=0;i<8 && cur;i++){
-                                        const hasPrice = cur.querySelector("[data-testid$='-price'], [data-testid*='price'], .price, [class*='price']");
-                                        const hasTime  = cur.querySelector("[data-testid*='time'], time, [class*='time'], [class*='hour'], [class*='departure'], [class*='schedule']");
-                                        if (hasPrice && (hasTime || i>0)) return cur;
-                                        cur = cur.parentElement;
-                                    }
-                                    return node;
-                                }
-                                function findTimeElements(container){
-                                    const timeSelectors = ["[data-testid*='time']","time","[class*='time']","[class*='hour']","[class*='departure']","[class*='schedule']"];
-                                    let timeElements = [];
-                                    timeSelectors.forEach(sel=>{
-                                        container.querySelectorAll(sel).forEach(el=>{
-                                            if (el.innerText && el.innerText.trim()) timeElements.push(el.innerText.trim());
-                                        });
-                                    });
-                                    const containerText = container.innerText || "";
-                                    const m = containerText.match(/(\\d{1,2}:\\d{2})\\s*(?:-|–|—|to|à)\\s*(\\d{1,2}:\\d{2})/gi);
-                                    if (m) timeElements.push(...m);
-                                    return timeElements;
-                                }
-                                const container = findContainer(el);
-                                const timeElements = findTimeElements(container);
-                                const labelEl = container.querySelector("[data-testid*='band'], [data-testid*='period'], [class*='morning'], [class*='afternoon'], [class*='matin'], [class*='apres']");
-                                return {
-                                    containerText: container && container.innerText ? container.innerText : '',
-                                    timeElements: timeElements,
-                                    labelText: labelEl && labelEl.innerText ? labelEl.innerText : ''
-                                };
-                            }
-                        """)
-                    except Exception:
-                        info = {}
-                else:
-                    info = {}
-
-                container_text = info.get("containerText","") if isinstance(info, dict) else ""
-                time_elements = info.get("timeElements",[]) if isinstance(info, dict) else []
-                label_text = info.get("labelText","") if isinstance(info, dict) else ""
-
-                time_range = None
-                for time_text in time_elements:
-                    time_range = _parse_time_range_from_text(time_text)
-                    if time_range: break
-                if not time_range:
-                    time_range = _parse_time_range_from_text(container_text)
-
-                band = _infer_band(label_text, time_range) or ("morning" if (time_range and int(time_range[0].split(":")[0]) < 14) else "afternoon")
-
-                if price_text != "€XX (debug)" and time_range:
-                    offers.append({"band": band, "price_text": price_text, "time_range": time_range})
-
-            if offers:
-                entry = {"route": route_name, "date": date, "url": url, "morning": None, "afternoon": None}
-                for band in ["morning","afternoon"]:
-                    band_offers = [o for o in offers if o["band"] == band]
-                    if band_offers:
-                        best = min(band_offers, key=lambda o: _price_to_float(o["price_text"])) 
-                        merged = _merge_time_ranges([o["time_range"] for o in band_offers if o["time_range"]])
-                        entry[band] = {"price_text": best["price_text"], "time_range": merged, "url": url}
-                if entry["morning"] or entry["afternoon"]:
-                    results.append(entry)
-            else:
-                results.append({"route": route_name, "date": date, "url": url, "morning": None, "afternoon": None})
+                    return await _scrape_snap_page(page, route_name, travel_date, url)
+                except PlaywrightError as e:
+                    if attempt + 1 == SNAP_MAX_ATTEMPTS:
+                        raise
+                    log.warning("[Snap] Retrying %s on %s after error: %s", route_name, travel_date, e)
+                    await asyncio.sleep(min(8, 2 ** attempt))
         except Exception as e:
-            print(f"Erreur SNAP pour {route_name} le {date} : {e}")
-
-    await browser.close()
-    return results
+            log.error("Erreur SNAP pour %s le %s : %s", route_name, travel_date, e)
+            return None
+        finally:
+            if ctx is not None:
+                await ctx.close()
+
+async def check_snap(browser, sem, route_name, search, dates):
+    base, params = search
+    urls = [f"{base}?{urllib.parse.urlencode({**params, 'outbound': d})}" for d in dates]
+    if EARLY_STOP_STREAK > 0:
+        # Fetch in ordered batches of the streak size so each batch still runs concurrently.
+        entries, empty_streak = [], 0
+        for i in range(0, len(dates), EARLY_STOP_STREAK):
+            batch = await asyncio.gather(*[
+                _fetch_snap_date(browser, sem, route_name, d, u)
+                for d, u in zip(dates[i:i + EARLY_STOP_STREAK], urls[i:i + EARLY_STOP_STREAK])
+            ])
+            for entry in batch:
+                if entry and (entry["morning"] or entry["afternoon"]):
+                    empty_streak = 0
+                elif entry:
+                    empty_streak += 1
+            entries.extend(batch)
+            if empty_streak >= EARLY_STOP_STREAK and i + EARLY_STOP_STREAK < len(dates):
+                log.info("[Snap] %s: %d empty dates in a row, skipping the rest", route_name, empty_streak)
+                break
+        return [e for e in entries if e]
+    entries = await asyncio.gather(*[_fetch_snap_date(browser, sem, route_name, d, u) for d, u in zip(dates, urls)])
+    return [e for e in entries if e]
+
+_TH_STYLE = 'style="border:1px solid #ddd;padding:8px;text-align:left;background:#f7f7f7"'
+_TD_STYLE = 'style="border:1px solid #ddd;padding:8px;text-align:left"'
+_TABLE_ROW = f"<tr><td {_TD_STYLE}>{{}}</td><td {_TD_STYLE}>{{}}</td><td {_TD_STYLE}>{{}}</td></tr>"
+_TABLE_HEAD = (
+    '<table style="border-collapse:collapse;width:100%;max-width:720px;font-family:Arial,Helvetica,sans-serif">'
+    f"<tr><th {_TH_STYLE}>Date</th><th {_TH_STYLE}>Morning</th><th {_TH_STYLE}>Afternoon</th></tr>"
+)
+_TABLE_TAIL = "</table>"
+
+def _format_slot_cell(slot):
+    if not slot: return "—<br/><small>no availability for now</small>"
+    price_html = f'<a href="{slot["url"]}">{slot["price_text"]}</a>'
+    if slot.get("time_range"):
+        start,end = slot["time_range"]; return f"{price_html}<br/><small>between {start} and {end}</small>"
+    return f"{price_html}<br/><small>no availability for now</small>"
+
+def _build_table(rows):
+    return _TABLE_HEAD + "".join(
+        _TABLE_ROW.format(_format_date_for_display(r['date']), _format_slot_cell(r.get('morning')), _format_slot_cell(r.get('afternoon')))
+        for r in rows
+    ) + _TABLE_TAIL
+
+_MAILGUN_CONN = None
+
+def _get_mailgun_conn():
+    global _MAILGUN_CONN
+    if _MAILGUN_CONN is None:
+        _MAILGUN_CONN = http.client.HTTPSConnection("api.eu.mailgun.net", timeout=MAILGUN_CONNECT_TIMEOUT)
+    return _MAILGUN_CONN
+
+def _mailgun_post(data, auth):
+    error = None
+    for attempt in range(MAILGUN_MAX_ATTEMPTS):
+        conn = _get_mailgun_conn()
+        reused = conn.sock is not None
+        if not reused:
+            try:
+                conn.connect()
+                conn.sock.settimeout(MAILGUN_READ_TIMEOUT)
+            except OSError as e:
+                conn.close()
+                error = e
+                if attempt + 1 < MAILGUN_MAX_ATTEMPTS:
+                    time.sleep(min(4, 0.5 * 2 ** attempt))
+                continue
+        try:
+            conn.request(
+                "POST",
+                f"/v3/{MAILGUN_DOMAIN}/messages",
+                body=data,
+                headers={
+                    "Authorization": f"Basic {auth}",
+                    "Content-Type": "application/x-www-form-urlencoded",
+                    "User-Agent": "eurostar-checker/1.0",
+                },
+            )
+        except OSError as e:
+            # A kept-alive socket the server already closed fails while the body is still being written.
+            conn.close()
+            if not reused:
+                raise
+            error = e
+        else:
+            try:
+                resp = conn.getresponse()
+                resp.read()
+            except http.client.RemoteDisconnected as e:
+                # Same stale socket, noticed only when reading: the server never took the request.
+                conn.close()
+                if not reused:
+                    raise
+                error = e
+            except (OSError, http.client.HTTPException):
+                # The message may already be queued; retrying could send it twice.
+                conn.close()
+                raise
+            else:
+                if resp.status in (200, 201):
+                    return
+                error = RuntimeError(f"Mailgun HTTP error: {resp.status}")
+                if resp.status < 500 and resp.status != 429:
+                    raise error
+        if attempt + 1 < MAILGUN_MAX_ATTEMPTS:
+            time.sleep(min(4, 0.5 * 2 ** attempt))
+    raise error
 
 def send_email_mailgun(available_entries):
-    def build_table(rows):
-        parts = []
-        th_style = 'style="border:1px solid #ddd;padding:8px;text-align:left;background:#f7f7f7"'
-        td_style = 'style="border:1px solid #ddd;padding:8px;text-align:left"'
-        parts.append('<table style="border-collapse:collapse;width:100%;max-width:720px;font-family:Arial,Helvetica,sans-serif">')
-        parts.append(f"<tr><th {th_style}>Date</th><th {th_style}>Morning</th><th {th_style}>Afternoon</th></tr>")
-        for r in rows:
-            def cell(slot):
-                if not slot: return "—<br/><small>no availability for now</small>"
-                price_html = f'<a href="{slot["url"]}">{slot["price_text"]}</a>'
-                if slot.get("time_range"):
-                    start,end = slot["time_range"]; return f"{price_html}<br/><small>between {start} and {end}</small>"
-                return f"{price_html}<br/><small>no availability for now</small>"
-            parts.append(f"<tr><td {td_style}>{_format_date_for_display(r['date'])}</td><td {td_style}>{cell(r.get('morning'))}</td><td {td_style}>{cell(r.get('afternoon'))}</td></tr>")
-        parts.append("</table>")
-        return ''.join(parts)
-
-    header = "<div style=\"font-family:Arial,Helvetica,sans-serif\"><h2>Eurostar Snap availability</h2></div>"
-    sections = []
-    for route in ["Paris → Amsterdam","Amsterdam → Paris"]:
-        route_entries = [e for e in available_entries if e["route"] == route]
-        if not route_entries:
-            continue
-        route_entries_sorted = sorted(route_entries, key=lambda e: e["date"])
-        table_html = build_table(route_entries_sorted)
-        sections.append(f"<h3 style=\"font-family:Arial,Helvetica,sans-serif\">{route}</h3>" + table_html)
-    html = header + "".join(sections) if sections else header + "<p>No availability for selected dates.</p>"
-
-    recipients = [email.strip() for email in EMAIL_RECIPIENT.split(",") if email.strip()]
+    digest = None
+    if EMAIL_DIGEST_PATH:
+        digest = hashlib.blake2b(json.dumps(available_entries, sort_keys=True).encode(), digest_size=16).hexdigest()
+        try:
+            with open(EMAIL_DIGEST_PATH) as f:
+                if f.read().strip() == digest:
+                    log.info("[Mailgun] Results unchanged since last email, not sending.")
+                    return
+        except OSError:
+            pass
+
+    parts = ["<div style=\"font-family:Arial,Helvetica,sans-serif\"><h2>Eurostar Snap availability</h2></div>"]
+    if available_entries:
+        for route in ["Paris → Amsterdam","Amsterdam → Paris"]:
+            route_entries = [e for e in available_entries if e["route"] == route]
+            if not route_entries:
+                continue
+            parts.append(f"<h3 style=\"font-family:Arial,Helvetica,sans-serif\">{route}</h3>")
+            parts.append(_build_table(sorted(route_entries, key=lambda e: e["date"])))
+    if len(parts) == 1:
+        parts.append("<p>No availability for selected dates.</p>")
+    html = "".join(parts)
+
     subject = "Eurostar Snap — disponibilité détectée" if any(e.get("morning") or e.get("afternoon") for e in available_entries) else "Eurostar Snap — rapport (aucune dispo)"
 
     auth = base64.b64encode(f"api:{MAILGUN_API_KEY}".encode()).decode()
 
-    for recipient in recipients:
-        data = urllib.parse.urlencode({
-            "from": f"Eurostar Snap <{MAILGUN_SENDER_EMAIL}>",
-            "to": recipient,
-            "subject": subject,
-            "html": html,
-        }).encode("utf-8")
-
-        req = urllib.request.Request(
-            f"https://api.eu.mailgun.net/v3/{MAILGUN_DOMAIN}/messages",
-            data=data,
-            headers={
-                "Authorization": f"Basic {auth}",
-            },
-            method="POST",
-        )
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            if resp.status not in (200, 201):
-                raise RuntimeError(f"Mailgun HTTP error: {resp.status}")
+    common = urllib.parse.urlencode({
+        "from": f"Eurostar Snap <{MAILGUN_SENDER_EMAIL}>",
+        "subject": subject,
+        "html": html,
+    })
+
+    for recipient in RECIPIENTS:
+        data = f"{common}&{urllib.parse.urlencode({'to': recipient})}".encode("utf-8")
+        _mailgun_post(data, auth)
+
+    if digest:
+        try:
+            with open(EMAIL_DIGEST_PATH, "w") as f:
+                f.write(digest)
+        except OSError as e:
+            log.warning("[Mailgun] Could not store email digest: %s", e)
 
 def main():
+    logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), format="%(message)s")
     if DATABASE_URL:
         init_db()
 
     async def run():
         async with async_playwright() as playwright:
-            snap_1 = await check_snap(playwright, "Paris → Amsterdam", SNAP_PARIS_TO_AMS)
-            snap_2 = await check_snap(playwright, "Amsterdam → Paris", SNAP_AMS_TO_PARIS)
+            browser = await playwright.chromium.launch(args=list(_CHROMIUM_ARGS))
+            try:
+                today = date.today()
+                dates = [(today + timedelta(days=i)).isoformat() for i in range(1, 9)]
+                sem = asyncio.Semaphore(SNAP_MAX_PARALLEL_PAGES)
+                snap_1, snap_2 = await asyncio.gather(
+                    check_snap(browser, sem, "Paris → Amsterdam", SNAP_PARIS_TO_AMS, dates),
+                    check_snap(browser, sem, "Amsterdam → Paris", SNAP_AMS_TO_PARIS, dates),
+                )
+            finally:
+                await browser.close()
             all_available = snap_1 + snap_2
-            print(f"ALL_AVAILABLE: {all_available}")
+            available_count = sum(1 for e in all_available if e.get("morning") or e.get("afternoon"))
+            print(f"ALL_AVAILABLE: {available_count}/{len(all_available)} dates with availability")
 
             if DATABASE_URL:
-                save_run_to_db(all_available)
+                await asyncio.to_thread(save_run_to_db, all_available)
 
-            send_email_mailgun(all_available)
+            await asyncio.to_thread(send_email_mailgun, all_available)
 
     asyncio.run(run())
 
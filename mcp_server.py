@@ -11,6 +11,49 @@ DATABASE_URL = os.getenv("DATABASE_URL")
 
 mcp = FastMCP("eurostar-checker")
 
+_DB_CONN = None
+
+
+def _get_db_conn():
+    global _DB_CONN
+    if _DB_CONN is None or _DB_CONN.closed:
+        _DB_CONN = psycopg2.connect(DATABASE_URL)
+        _DB_CONN.autocommit = True
+    return _DB_CONN
+
+
+def _fetch_latest_results():
+    global _DB_CONN
+    for attempt in range(2):
+        try:
+            conn = _get_db_conn()
+            with conn.cursor(cursor_factory=RealDictCursor) as cur:
+                cur.execute("""
+                    SELECT id, run_at
+                    FROM search_runs
+                    WHERE status = 'success'
+                    ORDER BY run_at DESC
+                    LIMIT 1
+                """)
+                run = cur.fetchone()
+                if not run:
+                    return None, []
+
+                cur.execute("""
+                    SELECT route, travel_date::text, period, price_text, time_start, time_end, url
+                    FROM search_results
+                    WHERE run_id = %s AND travel_date >= CURRENT_DATE
+                    ORDER BY route, travel_date, period
+                """, (run["id"],))
+                return run, cur.fetchall()
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            # The kept connection may have been dropped while idle; reconnect once.
+            if _DB_CONN is not None:
+                _DB_CONN.close()
+                _DB_CONN = None
+            if attempt:
+                raise
+
 
 @mcp.tool()
 def get_eurostar_availability() -> str:
@@ -23,31 +66,10 @@ def get_eurostar_availability() -> str:
         return "DATABASE_URL not configured."
 
     try:
-        conn = psycopg2.connect(DATABASE_URL)
-        cur = conn.cursor(cursor_factory=RealDictCursor)
-
-        cur.execute("""
-            SELECT id, run_at
-            FROM search_runs
-            WHERE status = 'success'
-            ORDER BY run_at DESC
-            LIMIT 1
-        """)
-        run = cur.fetchone()
-
+        run, rows = _fetch_latest_results()
         if not run:
             return "No availability data yet."
 
-        cur.execute("""
-            SELECT route, travel_date::text, period, price_text, time_start, time_end, url
-            FROM search_results
-            WHERE run_id = %s AND travel_date >= CURRENT_DATE
-            ORDER BY route, travel_date, period
-        """, (run["id"],))
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
-
         if not rows:
             return f"No availability found (last checked: {run['run_at'].strftime('%Y-%m-%d %H:%M UTC')})."
 